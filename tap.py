@@ -9,18 +9,108 @@ Based on MAX485 hardware schematic analysis
 
 import serial
 import serial.tools.list_ports
+import selectors
 import threading
+import queue
+import signal
 import time
 import argparse
+from array import array
+from collections import deque
 from datetime import datetime
-from collections import defaultdict
 import sys
 import os
 import json
+import errno
+import mmap
+import re
+import struct
+import traceback
+
+# termios hanya ada di POSIX
+try:
+    import termios
+except ImportError:
+    termios = None
+
+PORT_TYPES = frozenset(('RS232', 'RS422', 'RS485'))
+
+
+def _ascii_prefix_regex(patterns):
+    """
+    Regex bytes (satu DFA) untuk 'teks ASCII diawali salah satu pattern', case-insensitive.
+    Byte >= 0x80 di-skip di mana saja, sama seperti decode('ascii', errors='ignore').
+    """
+    skip = rb'[\x80-\xff]*'
+    alternatives = [skip.join(re.escape(bytes([c])) for c in p.encode('ascii')) for p in patterns]
+    return re.compile(rb'\A' + skip + rb'(?:' + b'|'.join(alternatives) + rb')', re.IGNORECASE)
 
 
 class SerialTapper:
-    def __init__(self, tap_ports, log_file=None, display_mode='both', log_format='hex'):
+    # Layout self.stats per port
+    STAT_TX, STAT_RX, STAT_TX_BYTES, STAT_RX_BYTES, STAT_DROPPED = range(5)
+    STAT_FIELDS = 5
+    
+    # Maksimal packet antre ke output thread; penuh → packet di-drop (STAT_DROPPED)
+    # supaya terminal/log yang macet tidak menahan pembacaan serial
+    OUTPUT_QUEUE_MAX = 4096
+    
+    # Maksimal byte per packet; stream kontinu tanpa gap dipecah di batas ini
+    MAX_PACKET_SIZE = 4096
+    
+    # Jumlah ukuran packet terakhir untuk rata-rata _detect_by_size
+    SIZE_HISTORY = 20
+    
+    # Jeda setelah open sebelum reset_input_buffer (detik)
+    OPEN_SETTLE = 0.05
+    
+    # Maksimal byte per os.read() saat fd readable
+    READ_SIZE = 65536
+    
+    # select() hanya bisa menunggu fd serial di POSIX; Windows pakai thread per port
+    USE_SELECT = os.name != 'nt'
+    
+    # Maksimal packet per batch output thread (satu write stdout + satu write log)
+    OUTPUT_BATCH = 64
+    
+    # Timeout select saat semua buffer kosong (seberapa cepat reader sadar stop)
+    IDLE_TICK = 0.5
+    STOP_TIMEOUT = 5.0  # batas tunggu output thread saat stop
+    MIN_READ_TIMEOUT = 0.001  # batas bawah ser.timeout di port_read_loop
+    # Read kosong / error beruntun sebelum port dianggap putus (EIO/ENXIO langsung)
+    READ_FAIL_LIMIT = 3
+    FATAL_READ_ERRNOS = frozenset((errno.EIO, errno.ENXIO))
+    
+    # Setiap sekian byte log yang sudah di-flush, lepas page cache-nya (fadvise)
+    LOG_FADVISE_BYTES = 8 << 20
+    
+    # Log biner (--log-format binary): BIN_MAGIC + satu baris JSON label per sesi,
+    # lalu record BIN_RECORD (time_ns, idx port, 0=TX/1=RX, len) + payload
+    BIN_MAGIC = b'TAPBIN1\n'
+    BIN_RECORD = struct.Struct('<QBBH')
+    BIN_MAX_PORTS = 256  # idx dipack sebagai 'B'
+    
+    # Prefix ASCII untuk _detect_by_pattern, dikompilasi sekali saat import
+    PATTERN_TX_RE = _ascii_prefix_regex(['AT+', 'AT', 'GET', 'POST', 'SET', 'READ', 'WRITE', '$', '?'])
+    PATTERN_RX_RE = _ascii_prefix_regex(['OK', 'ERROR', '+', 'HTTP/', '200', '404'])
+    
+    # Byte pertama packet biner: < 0x20 → TX (command/control), > 0x80 → RX
+    FIRST_BYTE_DIRECTION = tuple("TX" if b < 0x20 else "RX" if b > 0x80 else None
+                                 for b in range(256))
+    
+    # Modbus function code sebagai bitmask: cek = (MASK >> func) & 1
+    MODBUS_READ_FUNCS = sum(1 << fc for fc in (0x01, 0x02, 0x03, 0x04))
+    MODBUS_WRITE_MULTI = sum(1 << fc for fc in (0x0F, 0x10))
+    MODBUS_VALID_FUNCS = (MODBUS_READ_FUNCS | MODBUS_WRITE_MULTI
+                          | sum(1 << fc for fc in (0x05, 0x06, 0x17)))
+    
+    # Lookup table format ASCII, dihitung sekali saat import
+    PRINTABLE = bytes(range(32, 127))
+    ASCII_DOT_TABLE = bytes(b if 32 <= b < 127 else 0x2E for b in range(256))
+    ASCII_ESCAPE_TABLE = [chr(b) if 32 <= b < 127 else f'[{b:02X}]' for b in range(256)]
+    
+    def __init__(self, tap_ports, log_file=None, display_mode='both', log_format='hex',
+                 low_latency=False, quiet=False, color='auto', latency_timer=None):
         """
         Initialize Serial Tapper dengan per-port configuration
         
@@ -40,31 +130,61 @@ class SerialTapper:
             log_file: Path file log (optional)
             display_mode: Mode display console - hex/ascii/both
             log_format: Format data di log - hex/ascii
+            low_latency: Set ASYNC_LOW_LATENCY (Linux, USB-serial/FTDI) saat open
+            latency_timer: Tulis latency_timer FTDI di sysfs (ms); default 1 kalau low_latency
+            quiet: Tanpa output per packet di console (hanya log + statistik)
+            color: auto/always/never - auto = ANSI hanya kalau stdout TTY
         """
         self.tap_ports = tap_ports
         self.log_file = log_file
         self.display_mode = display_mode
+        self._render_body = {
+            'hex': self._render_hex,
+            'ascii': self._render_ascii,
+            'both': self._render_both,
+        }.get(display_mode, self._render_none)
         self.log_format = log_format
+        self._append_log = {
+            'ascii': self._append_log_ascii,
+            'binary': self._append_log_binary,
+        }.get(log_format, self._append_log_hex)
+        self.low_latency = low_latency
+        if latency_timer is None and low_latency:
+            latency_timer = 1
+        self.latency_timer = latency_timer
+        self.quiet = quiet
         
         self.serial_connections = []
         self.running = False
         self.threads = []
+        self.stop_event = threading.Event()
         
-        # Statistics per port
-        self.stats = defaultdict(lambda: {
-            'bytes': 0, 'packets': 0, 'tx': 0, 'rx': 0, 
-            'tx_bytes': 0, 'rx_bytes': 0
-        })
+        # Reader thread → output thread (display + log), supaya stdout/file I/O
+        # yang lambat tidak menahan pembacaan serial
+        self.output_queue = queue.Queue(maxsize=self.OUTPUT_QUEUE_MAX)
+        self.output_thread = None
+        self._stdout_fd = None
         
-        # Packet assembly per port
-        self.packet_buffer = defaultdict(bytearray)
-        self.last_receive_time = defaultdict(float)
-        self.buffer_lock = threading.Lock()
+        # Log file: satu handle buffered untuk seluruh sesi
+        self._log_fh = None
+        self._log_lock = threading.Lock()
+        self.log_flush_interval = 1.0
+        self._line_buf = bytearray()  # batch log, dipakai ulang oleh output_loop
+        
+        # Cache prefix timestamp per detik (lihat _timestamp)
+        # (tuple supaya tetap konsisten kalau dipanggil dari beberapa reader thread)
+        self._ts_cache = (0, '')
+        
+        # Statistics per port: array flat, slot conn['idx'] * STAT_FIELDS + STAT_*
+        # (total bytes/packets = TX + RX, dihitung saat print)
+        self.stats = array('Q')
         
         # Direction detection per port
-        self.last_direction = defaultdict(lambda: "TX")
-        self.packet_history = defaultdict(list)
-        self.last_packet_time = defaultdict(float)
+        # (list per port, index = conn_info['idx'], diisi di open_connections)
+        self.rs485_last_direction = []
+        self.packet_history = []
+        self.packet_size_sum = []
+        self.last_packet_time = []
         
         # Colors
         self.colors = {
@@ -77,6 +197,9 @@ class SerialTapper:
             'magenta': '\033[95m',
             'cyan': '\033[96m',
         }
+        # Output di-redirect (nohup/pipe) → tanpa escape ANSI
+        if color == 'never' or (color == 'auto' and not sys.stdout.isatty()):
+            self.colors = dict.fromkeys(self.colors, '')
         
         self.color_list = ['cyan', 'green', 'yellow', 'magenta', 'blue', 'red']
     
@@ -111,12 +234,66 @@ class SerialTapper:
             else:
                 return False, f"Error: {error_msg}"
     
+    def enable_low_latency(self, ser):
+        """
+        Set flag ASYNC_LOW_LATENCY via TIOCGSERIAL/TIOCSSERIAL (setserial low_latency)
+        
+        Tanpa ini, driver USB-serial (FTDI dll) menahan byte sampai 16ms
+        sebelum dikirim ke userspace.
+        
+        Returns:
+            (success, message)
+        """
+        if not sys.platform.startswith('linux'):
+            return False, "hanya didukung di Linux"
+        try:
+            ser.set_low_latency_mode(True)
+            return True, "ON"
+        except (AttributeError, ValueError, OSError) as e:
+            return False, f"tidak didukung driver ({e})"
+    
+    def set_latency_timer(self, ser, ms):
+        """
+        Tulis /sys/class/tty/<tty>/device/latency_timer (FTDI ftdi_sio, default 16ms).
+        Timer ini yang menahan data di chip, jadi ASYNC_LOW_LATENCY saja tidak cukup
+        di kernel lama.
+        
+        Returns:
+            (success, message)
+        """
+        tty_name = os.path.basename(os.path.realpath(ser.port))
+        path = f"/sys/class/tty/{tty_name}/device/latency_timer"
+        if not os.path.exists(path):
+            return False, "tidak ada (bukan FTDI / bukan Linux)"
+        try:
+            with open(path, 'w') as f:
+                f.write(str(ms))
+            return True, f"{ms}ms"
+        except OSError as e:
+            return False, f"gagal tulis {path} ({e})"
+    
+    def configure_raw_read(self, ser):
+        """
+        Set VMIN=0/VTIME=0 supaya read() di fd langsung return apa yang ada
+        di kernel buffer - cocok dengan readiness notification dari selectors
+        """
+        if termios is None:
+            return
+        fd = ser.fileno()
+        attrs = termios.tcgetattr(fd)
+        attrs[6][termios.VMIN] = 0
+        attrs[6][termios.VTIME] = 0
+        termios.tcsetattr(fd, termios.TCSANOW, attrs)
+    
     def open_connections(self):
         """Buka koneksi ke semua tap ports dengan individual configuration"""
         print("\n" + "="*80)
         print("  OPENING SERIAL CONNECTIONS")
         print("="*80)
         
+        # Log divalidasi sebelum port dibuka: gagal di sini, bukan di tengah sesi
+        self.open_log_file()
+        
         for idx, config in enumerate(self.tap_ports):
             port_name = config['port']
             label = config.get('label', port_name.split('/')[-1])
@@ -151,10 +328,26 @@ class SerialTapper:
                     timeout=timeout
                 )
                 
+                # Tunggu driver/device siap dulu, baru buang data lama di input buffer
+                # (reset tepat setelah open bisa terlalu cepat, sisa byte lolos)
+                time.sleep(self.OPEN_SETTLE)
                 ser.reset_input_buffer()
+                self.configure_raw_read(ser)
+                
+                low_latency_msg = None
+                if self.low_latency:
+                    _, low_latency_msg = self.enable_low_latency(ser)
+                
+                latency_timer_msg = None
+                if self.latency_timer is not None:
+                    _, latency_timer_msg = self.set_latency_timer(ser, self.latency_timer)
+                
+                ansi_sep = (f"{self.colors[color]}{self.colors['bold']}{'─'*80}"
+                            f"{self.colors['reset']}\n")
                 
                 # Store connection info dengan full config
                 self.serial_connections.append({
+                    'idx': len(self.serial_connections),
                     'serial': ser,
                     'port': port_name,
                     'label': label,
@@ -165,20 +358,102 @@ class SerialTapper:
                     'stopbits': stopbits,
                     'type': port_type,
                     'detection': detection,
-                    'packet_timeout': packet_timeout
+                    'packet_timeout': packet_timeout,
+                    'packet_timeout_ns': int(packet_timeout * 1e9),
+                    # ANSI/header yang konstan per port, dihitung sekali
+                    'ansi_color': self.colors[color],
+                    # header = header_open + timestamp + header_dir[TX/RX] + "<len>B"
+                    'header_open': ansi_sep + f"{self.colors[color]}[",
+                    'header_dir': {
+                        d: f"] {label} ({port_name}) [{port_type}] {arrow} {d} | Len: "
+                        for d, arrow in (("TX", "→"), ("RX", "←"))
+                    },
+                    'log_prefix': {d: f"{label} | {d} : ".encode('utf-8') for d in ("TX", "RX")},
+                    # Packet assembly state, hanya disentuh oleh reader thread
+                    'buf': bytearray(),
+                    'last_rx': 0,  # time.monotonic_ns()
+                    # Alternating toggle: paket pertama = RX
+                    'tx_next': False,
+                    # Arah potongan pertama burst > MAX_PACKET_SIZE (lihat _handle_chunk)
+                    'cont_dir': None,
+                    # Read kosong/error beruntun (select_loop)
+                    'read_fails': 0,
+                    'detect_fn': self.detector_for(detection, port_type)
                 })
+                self.stats.extend([0] * self.STAT_FIELDS)
+                self.rs485_last_direction.append("RX")
+                self.packet_history.append(deque(maxlen=self.SIZE_HISTORY))
+                self.packet_size_sum.append(0)
+                self.last_packet_time.append(None)
                 
                 print(f"  {self.colors['green']}✓{self.colors['reset']} "
                       f"{label:<30} ({port_name})")
                 print(f"      Baud: {baudrate} | Data: {bytesize}{parity}{stopbits} | "
                       f"Type: {port_type} | Detection: {detection} | "
                       f"Timeout: {packet_timeout*1000:.0f}ms")
+                if low_latency_msg:
+                    print(f"      Low-latency: {low_latency_msg}")
+                if latency_timer_msg:
+                    print(f"      Latency timer: {latency_timer_msg}")
                 
             except serial.SerialException as e:
                 print(f"  {self.colors['red']}✗{self.colors['reset']} {label:<30} - ERROR: {e}")
                 raise
         
         print("="*80 + "\n")
+        
+        if self._log_fh is not None and self.log_format == 'binary':
+            # Header sesi: decoder (--dump) butuh label per idx
+            labels = [conn['label'] for conn in self.serial_connections]
+            self._write_log(self.BIN_MAGIC + json.dumps(labels).encode('utf-8') + b'\n')
+    
+    def open_log_file(self):
+        """Buka log file sekali (append, buffer 1 MiB) untuk seluruh sesi"""
+        if self.log_file and self._log_fh is None:
+            if self.log_format == 'binary' and len(self.tap_ports) > self.BIN_MAX_PORTS:
+                print(f"\n{self.colors['red']}PROGRAM DIHENTIKAN{self.colors['reset']} - Log biner "
+                      f"maksimal {self.BIN_MAX_PORTS} port ({len(self.tap_ports)} diberikan)\n")
+                sys.exit(1)
+            try:
+                self._log_fh = open(self.log_file, 'ab', buffering=1 << 20)
+            except OSError as e:
+                print(f"  {self.colors['red']}✗{self.colors['reset']} Log file {self.log_file} - {e}")
+                print(f"\n{self.colors['red']}PROGRAM DIHENTIKAN{self.colors['reset']} - Log file tidak bisa dibuka\n")
+                sys.exit(1)
+    
+    def close_log_file(self):
+        """Flush dan tutup log file"""
+        with self._log_lock:
+            if self._log_fh is not None:
+                try:
+                    self._log_fh.close()
+                    self._log_fh = None
+                except OSError as e:
+                    self._log_failed(e)
+    
+    def _log_flush_loop(self):
+        """Flush buffer log secara periodik supaya `tail -f` tetap up-to-date"""
+        fadvise = getattr(os, 'posix_fadvise', None)
+        released = 0
+        while not self.stop_event.wait(self.log_flush_interval):
+            with self._log_lock:
+                if self._log_fh is None:
+                    continue
+                try:
+                    self._log_fh.flush()
+                except OSError as e:
+                    self._log_failed(e)
+                    continue
+                
+                # Sesi panjang: log yang sudah ditulis tidak perlu menghuni page cache
+                if fadvise is not None:
+                    pos = self._log_fh.tell()
+                    if pos - released >= self.LOG_FADVISE_BYTES:
+                        try:
+                            fadvise(self._log_fh.fileno(), 0, pos, os.POSIX_FADV_DONTNEED)
+                        except OSError:
+                            fadvise = None
+                        released = pos
     
     def close_connections(self):
         """Tutup semua koneksi"""
@@ -197,19 +472,24 @@ class SerialTapper:
                       f"{conn['label']:<30} - ERROR: {e}")
         
         print("="*80 + "\n")
+        
+        self.close_log_file()
     
     def format_hex(self, data):
-        """Format data ke HEX"""
-        return ' '.join(f'{b:02X}' for b in data)
+        """Format data ke HEX (bytes.hex di C, bukan loop per byte)"""
+        return data.hex(' ').upper()
     
     def format_ascii(self, data):
-        """Format data ke ASCII"""
-        return ''.join(chr(b) if 32 <= b < 127 else f'[{b:02X}]' for b in data)
+        """Format data ke ASCII, non-printable jadi [XX]"""
+        # Fast path: semua printable → langsung decode
+        if not data.translate(None, self.PRINTABLE):
+            return data.decode('ascii')
+        return ''.join(map(self.ASCII_ESCAPE_TABLE.__getitem__, data))
     
     def format_mixed(self, data):
         """Format HEX dan ASCII"""
-        hex_str = ' '.join(f'{b:02X}' for b in data)
-        ascii_str = ''.join(chr(b) if 32 <= b < 127 else '.' for b in data)
+        hex_str = data.hex(' ').upper()
+        ascii_str = data.translate(self.ASCII_DOT_TABLE).decode('ascii')
         return hex_str, ascii_str
     
     def _analyze_rs485_packet_structure(self, data):
@@ -238,16 +518,12 @@ class SerialTapper:
         if func & 0x80:
             return "RX"
         
-        # Valid function codes
-        READ_FUNCS = [0x01, 0x02, 0x03, 0x04]
-        WRITE_SINGLE = [0x05, 0x06]
-        WRITE_MULTI = [0x0F, 0x10]
-        
-        if func not in (READ_FUNCS + WRITE_SINGLE + WRITE_MULTI + [0x17]):
+        # Valid function codes (func < 0x80 di sini, error bit sudah ditangani)
+        if not (self.MODBUS_VALID_FUNCS >> func) & 1:
             return None
         
         # Read functions
-        if func in READ_FUNCS:
+        if (self.MODBUS_READ_FUNCS >> func) & 1:
             if len(data) == 8:
                 return "TX"  # Read request
             elif len(data) > 8:
@@ -257,7 +533,7 @@ class SerialTapper:
                     return "RX"  # Read response
         
         # Write multiple
-        if func in WRITE_MULTI:
+        if (self.MODBUS_WRITE_MULTI >> func) & 1:
             if len(data) == 8:
                 return "RX"  # Response
             elif len(data) > 8:
@@ -265,7 +541,7 @@ class SerialTapper:
         
         return None
     
-    def _detect_rs485_hardware_aware(self, data, port_name, conn_info):
+    def _detect_rs485_hardware_aware(self, data, idx, conn_info):
         """
         RS-485 detection berdasarkan MAX485 hardware behavior
         
@@ -285,29 +561,30 @@ class SerialTapper:
         if len(data) < 2:
             return "TX"
         
-        current_time = time.time()
+        # Monotonic ns: gap tidak ikut lompat kalau jam sistem di-adjust (NTP)
+        current_time = time.monotonic_ns()
         
         # Method 1: Error bit (definitive)
         func_code = data[1]
         if func_code & 0x80:
-            self.last_packet_time[port_name] = current_time
+            self.last_packet_time[idx] = current_time
             return "RX"  # Slave error response
         
         # Method 2: Packet structure
         structure_result = self._analyze_rs485_packet_structure(data)
         if structure_result:
-            self.last_packet_time[port_name] = current_time
+            self.last_packet_time[idx] = current_time
             return structure_result
         
         # Method 3: Timing analysis
-        if port_name in self.last_packet_time:
-            gap = current_time - self.last_packet_time[port_name]
+        if self.last_packet_time[idx] is not None:
+            gap = current_time - self.last_packet_time[idx]
             
-            if gap < 0.1:  # < 100ms → quick slave response
-                self.last_packet_time[port_name] = current_time
+            if gap < 100_000_000:  # < 100ms → quick slave response
+                self.last_packet_time[idx] = current_time
                 return "RX"
-            elif gap > 0.5:  # > 500ms → new master request
-                self.last_packet_time[port_name] = current_time
+            elif gap > 500_000_000:  # > 500ms → new master request
+                self.last_packet_time[idx] = current_time
                 return "TX"
         
         # Method 4: Size heuristic
@@ -315,7 +592,7 @@ class SerialTapper:
         size_hint = "TX" if packet_len <= 8 else "RX"
         
         # Method 5: Alternating (hardware half-duplex)
-        last_dir = self.last_direction.get(f'rs485_{port_name}', "RX")
+        last_dir = self.rs485_last_direction[idx]
         
         # Combine size hint dengan alternating
         if size_hint == "TX" and last_dir == "RX":
@@ -325,8 +602,8 @@ class SerialTapper:
         else:
             new_dir = "RX" if last_dir == "TX" else "TX"
         
-        self.last_direction[f'rs485_{port_name}'] = new_dir
-        self.last_packet_time[port_name] = current_time
+        self.rs485_last_direction[idx] = new_dir
+        self.last_packet_time[idx] = current_time
         
         return new_dir
     
@@ -335,232 +612,548 @@ class SerialTapper:
         if len(data) == 0:
             return None
         
-        try:
-            text = data.decode('ascii', errors='ignore').upper()
-            
-            # TX patterns
-            tx_patterns = ['AT+', 'AT', 'GET', 'POST', 'SET', 'READ', 'WRITE', '$', '?']
-            for pattern in tx_patterns:
-                if text.startswith(pattern):
-                    return "TX"
-            
-            # RX patterns
-            rx_patterns = ['OK', 'ERROR', '+', 'HTTP/', '200', '404']
-            for pattern in rx_patterns:
-                if text.startswith(pattern):
-                    return "RX"
-        except:
-            pass
-        
-        # Binary patterns
-        first_byte = data[0]
-        if first_byte < 0x20:
+        # TX/RX patterns: match langsung di bytes, tanpa decode per packet
+        if self.PATTERN_TX_RE.match(data):
             return "TX"
-        elif first_byte > 0x80:
+        if self.PATTERN_RX_RE.match(data):
             return "RX"
         
-        return None
+        # Binary patterns: arah dari byte pertama (lookup, tanpa branch)
+        return self.FIRST_BYTE_DIRECTION[data[0]]
     
-    def _detect_by_size(self, port_name, data):
+    def _detect_by_size(self, idx, data):
         """Size-based detection dengan adaptive learning"""
-        if port_name not in self.packet_history:
-            self.packet_history[port_name] = []
-        
-        self.packet_history[port_name].append(len(data))
-        
-        if len(self.packet_history[port_name]) > 20:
-            self.packet_history[port_name] = self.packet_history[port_name][-20:]
-        
-        if len(self.packet_history[port_name]) < 4:
-            return "TX" if len(data) < 64 else "RX"
-        
-        avg_size = sum(self.packet_history[port_name]) / len(self.packet_history[port_name])
-        return "TX" if len(data) < avg_size else "RX"
+        # deque(maxlen) + running sum: O(1) per packet, tanpa slice/sum ulang
+        history = self.packet_history[idx]
+        size = len(data)
+        if len(history) == history.maxlen:
+            self.packet_size_sum[idx] -= history[0]
+        history.append(size)
+        self.packet_size_sum[idx] += size
+        
+        if len(history) < 4:
+            return "TX" if size < 64 else "RX"
+        
+        avg_size = self.packet_size_sum[idx] / len(history)
+        return "TX" if size < avg_size else "RX"
+    
+    def _toggle_direction(self, conn_info):
+        """Alternating toggle: satu bool per koneksi (tx_next)"""
+        tx_next = conn_info['tx_next']
+        conn_info['tx_next'] = not tx_next
+        return "TX" if tx_next else "RX"
     
-    def detect_direction_smart(self, port_name, port_type, detection_mode, data, conn_info):
+    def detector_for(self, detection_mode, port_type):
         """
-        Smart detection dengan per-port configuration
+        Pilih fungsi detection sekali per port (mode & type tidak berubah selama sesi)
         
-        Args:
-            port_name: Nama port
-            port_type: RS232/RS422/RS485
-            detection_mode: Mode detection untuk port ini
-            data: Data packet
-            conn_info: Full connection info
-            
         Returns:
-            'TX' atau 'RX'
+            Callable (data, conn_info) -> 'TX' atau 'RX'
         """
-        
-        # Mode 'none' - all RX
+        # Mode eksplisit menang atas port type
         if detection_mode == 'none':
-            return "RX"
-        
-        # Mode 'alternating' - simple toggle
+            return self._detect_none
         if detection_mode == 'alternating':
-            current = self.last_direction[port_name]
-            new_dir = "RX" if current == "TX" else "TX"
-            self.last_direction[port_name] = new_dir
-            return new_dir
-        
-        # Mode 'pattern' - pattern recognition
+            return self._detect_alternating
         if detection_mode == 'pattern':
-            result = self._detect_by_pattern(data)
-            if result:
-                return result
-            # Fallback to alternating
-            current = self.last_direction[port_name]
-            new_dir = "RX" if current == "TX" else "TX"
-            self.last_direction[port_name] = new_dir
-            return new_dir
-        
-        # Mode 'size' - size-based
+            return self._detect_pattern_mode
         if detection_mode == 'size':
-            return self._detect_by_size(port_name, data)
+            return self._detect_size_mode
         
-        # Mode 'rs485' - RS-485 specific (hardware-aware)
+        # RS-485 (mode rs485, atau auto di port RS485): hardware-aware
         if detection_mode == 'rs485' or port_type == 'RS485':
-            return self._detect_rs485_hardware_aware(data, port_name, conn_info)
+            return self._detect_rs485_mode
         
-        # Mode 'auto' - smart combination
         if detection_mode == 'auto':
-            # RS-485: use hardware-aware detection
-            if port_type == 'RS485':
-                return self._detect_rs485_hardware_aware(data, port_name, conn_info)
-            
-            # RS-232/RS-422: combine pattern + size
-            pattern_result = self._detect_by_pattern(data)
-            size_result = self._detect_by_size(port_name, data)
-            
-            if pattern_result == size_result and pattern_result is not None:
-                self.last_direction[port_name] = pattern_result
-                return pattern_result
-            
-            # Fallback: alternating
-            current = self.last_direction[port_name]
-            new_dir = "RX" if current == "TX" else "TX"
-            self.last_direction[port_name] = new_dir
-            return new_dir
+            return self._detect_auto
         
         # Default: alternating
-        current = self.last_direction[port_name]
-        new_dir = "RX" if current == "TX" else "TX"
-        self.last_direction[port_name] = new_dir
-        return new_dir
+        return self._detect_alternating
+    
+    # Mode 'none' - all RX
+    def _detect_none(self, data, conn_info):
+        return "RX"
+    
+    # Mode 'alternating' - simple toggle
+    def _detect_alternating(self, data, conn_info):
+        return self._toggle_direction(conn_info)
+    
+    # Mode 'pattern' - pattern recognition, fallback alternating
+    def _detect_pattern_mode(self, data, conn_info):
+        return self._detect_by_pattern(data) or self._toggle_direction(conn_info)
+    
+    # Mode 'size' - size-based
+    def _detect_size_mode(self, data, conn_info):
+        return self._detect_by_size(conn_info['idx'], data)
+    
+    # Mode 'rs485' - RS-485 specific (hardware-aware)
+    def _detect_rs485_mode(self, data, conn_info):
+        return self._detect_rs485_hardware_aware(data, conn_info['idx'], conn_info)
+    
+    # Mode 'auto' (RS-232/RS-422) - combine pattern + size, fallback alternating
+    def _detect_auto(self, data, conn_info):
+        pattern_result = self._detect_by_pattern(data)
+        size_result = self._detect_by_size(conn_info['idx'], data)
+        
+        if pattern_result == size_result and pattern_result is not None:
+            conn_info['tx_next'] = pattern_result == "RX"
+            return pattern_result
+        
+        return self._toggle_direction(conn_info)
+    
+    def display_data(self, conn_info, data, timestamp, direction, hex_str=None, out=None):
+        """
+        Display data ke console (hex_str: hasil format_hex yang sudah ada, opsional).
+        Kalau out (list) diberikan, teks hanya ditambahkan ke out dan caller yang menulis.
+        """
+        # Rakit semua baris lalu tulis sekali
+        write_now = out is None
+        if write_now:
+            out = []
+        color = conn_info['ansi_color']
+        reset = self.colors['reset']
+        out.append(f"{conn_info['header_open']}{timestamp}"
+                   f"{conn_info['header_dir'][direction]}{len(data)}B{reset}\n")
+        
+        # Data (renderer sesuai display_mode, dipilih sekali di __init__)
+        self._render_body(data, hex_str, color, reset, out)
+        
+        out.append("\n")
+        if write_now:
+            sys.stdout.write(''.join(out))
+    
+    def _render_hex(self, data, hex_str, color, reset, out):
+        if hex_str is None:
+            hex_str = self.format_hex(data)
+        out.append(f"{color}HEX:   {hex_str}{reset}\n")
+    
+    def _render_ascii(self, data, hex_str, color, reset, out):
+        out.append(f"{color}ASCII: {self.format_ascii(data)}{reset}\n")
     
-    def display_data(self, conn_info, data, timestamp, direction):
-        """Display data ke console"""
-        label = conn_info['label']
-        port = conn_info['port']
-        port_type = conn_info.get('type', 'RS232')
-        color = self.colors[conn_info['color']]
-        
-        # Update stats
-        self.stats[port]['bytes'] += len(data)
-        self.stats[port]['packets'] += 1
-        if direction == "TX":
-            self.stats[port]['tx'] += 1
-            self.stats[port]['tx_bytes'] += len(data)
+    def _render_both(self, data, hex_str, color, reset, out):
+        if hex_str is None:
+            hex_str, ascii_data = self.format_mixed(data)
         else:
-            self.stats[port]['rx'] += 1
-            self.stats[port]['rx_bytes'] += len(data)
-        
-        # Header
-        arrow = "→" if direction == "TX" else "←"
-        print(f"{color}{self.colors['bold']}{'─'*80}{self.colors['reset']}")
-        print(f"{color}[{timestamp}] {label} ({port}) [{port_type}] {arrow} {direction} | "
-              f"Len: {len(data)}B{self.colors['reset']}")
-        
-        # Data
-        if self.display_mode == 'hex':
-            print(f"{color}HEX:   {self.format_hex(data)}{self.colors['reset']}")
-        elif self.display_mode == 'ascii':
-            print(f"{color}ASCII: {self.format_ascii(data)}{self.colors['reset']}")
-        elif self.display_mode == 'both':
-            hex_data, ascii_data = self.format_mixed(data)
-            print(f"{color}HEX:   {hex_data}{self.colors['reset']}")
-            print(f"{color}ASCII: {ascii_data}{self.colors['reset']}")
-        
-        print()
-    
-    def write_to_log(self, conn_info, data, timestamp, direction):
-        """Write ke log file"""
-        if not self.log_file:
+            ascii_data = data.translate(self.ASCII_DOT_TABLE).decode('ascii')
+        out.append(f"{color}HEX:   {hex_str}{reset}\n{color}ASCII: {ascii_data}{reset}\n")
+    
+    def _render_none(self, data, hex_str, color, reset, out):
+        pass
+    
+    def write_to_log(self, conn_info, data, timestamp, direction, hex_str=None, batch=None,
+                     ns=None):
+        """
+        Write ke log file (buffered, di-flush periodik oleh _log_flush_loop).
+        Kalau batch (bytearray) diberikan, baris hanya ditambahkan ke batch.
+        ns: time_ns packet, dipakai format binary (default: sekarang)
+        """
+        if self._log_fh is None:
             return
         
+        line = batch if batch is not None else bytearray()
+        self._append_log(line, conn_info, data, timestamp, direction, hex_str, ns)
+        if batch is None:
+            self._write_log(line)
+    
+    # Formatter per log_format, dipilih sekali di __init__ (self._append_log)
+    # Prefix "label | DIR : " sudah bytes; hex/ascii/timestamp murni ASCII
+    def _append_log_hex(self, line, conn_info, data, timestamp, direction, hex_str, ns):
+        line += conn_info['log_prefix'][direction]
+        line += timestamp.encode('ascii')
+        line += b' '
+        line += (hex_str if hex_str is not None else self.format_hex(data)).encode('ascii')
+        line += b'\n'
+    
+    def _append_log_ascii(self, line, conn_info, data, timestamp, direction, hex_str, ns):
+        line += conn_info['log_prefix'][direction]
+        line += timestamp.encode('ascii')
+        line += b' '
+        line += self.format_ascii(data).encode('ascii')
+        line += b'\n'
+    
+    def _append_log_binary(self, line, conn_info, data, timestamp, direction, hex_str, ns):
+        # Payload mentah, tanpa hex encode
+        line += self.BIN_RECORD.pack(ns if ns is not None else time.time_ns(),
+                                     conn_info['idx'], direction == "RX", len(data))
+        line += data
+    
+    def _write_log(self, data):
+        """
+        Satu write ke log handle. Gagal (disk penuh, device hilang) → lapor sekali
+        dan logging dimatikan; display tetap jalan.
+        """
+        with self._log_lock:
+            if self._log_fh is None:
+                return
+            try:
+                self._log_fh.write(data)
+            except OSError as e:
+                self._log_failed(e)
+    
+    def _log_failed(self, error):
+        """Lapor error log sekali lalu lepas handle (dipanggil dengan _log_lock dipegang)"""
+        print(f"{self.colors['red']}Error writing to log: {error} - logging dihentikan{self.colors['reset']}")
         try:
-            with open(self.log_file, 'a') as f:
-                if self.log_format == 'ascii':
-                    data_str = self.format_ascii(data)
-                else:
-                    data_str = self.format_hex(data)
-                
-                # Include port label in log
-                label = conn_info['label']
-                f.write(f"{label} | {direction} : {timestamp} {data_str}\n")
-        except Exception as e:
-            print(f"{self.colors['red']}Error writing to log: {e}{self.colors['reset']}")
-    
-    def flush_packet_buffer(self, port_name, conn_info):
-        """Flush complete packet"""
-        with self.buffer_lock:
-            if port_name in self.packet_buffer and len(self.packet_buffer[port_name]) > 0:
-                complete_packet = bytes(self.packet_buffer[port_name])
-                timestamp = datetime.now().strftime('%Y-%m-%d %H:%M:%S.%f')[:-3]
-                
-                # Detect direction dengan per-port config
-                port_type = conn_info.get('type', 'RS232')
-                detection_mode = conn_info.get('detection', 'auto')
+            self._log_fh.close()
+        except OSError:
+            pass
+        self._log_fh = None
+    
+    def _timestamp(self, ns):
+        """time_ns → 'YYYY-mm-dd HH:MM:SS.mmm'; strftime hanya sekali per detik"""
+        sec, sub = divmod(ns, 1_000_000_000)
+        cached_sec, prefix = self._ts_cache
+        if sec != cached_sec:
+            prefix = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(sec))
+            self._ts_cache = (sec, prefix)
+        return f"{prefix}.{sub // 1_000_000:03d}"
+    
+    def flush_packet_buffer(self, conn_info):
+        """
+        Flush complete packet
+        
+        Returns:
+            Arah packet ('TX'/'RX'), atau None kalau buffer kosong
+        """
+        buf = conn_info['buf']
+        if not buf:
+            conn_info['cont_dir'] = None
+            return None
+        
+        # Serah-terimakan bytearray ke output thread (tanpa copy);
+        # reader lanjut dengan buffer baru
+        complete_packet = buf
+        conn_info['buf'] = bytearray()
+        ns = time.time_ns()
+        
+        # Potongan lanjutan (burst > MAX_PACKET_SIZE) ikut arah potongan pertama,
+        # tanpa lewat detector (state timing/size/toggle tidak ikut berubah)
+        direction = conn_info['cont_dir']
+        if direction is None:
+            # Detect direction: fungsi per port sudah dipilih di open_connections
+            direction = conn_info['detect_fn'](complete_packet, conn_info)
+        else:
+            conn_info['cont_dir'] = None
+        
+        try:
+            self.output_queue.put_nowait((conn_info, complete_packet, ns, direction))
+        except queue.Full:
+            self.stats[conn_info['idx'] * self.STAT_FIELDS + self.STAT_DROPPED] += 1
+        return direction
+    
+    def output_loop(self):
+        """Consumer: display + log semua packet dari output_queue sampai sentinel None"""
+        show = not self.quiet
+        need_ts = show or (self._log_fh is not None and self.log_format != 'binary')
+        self._share_hex = (show and self._log_fh is not None and self.log_format == 'hex'
+                           and self.display_mode in ('hex', 'both'))
+        
+        # fd mentah hanya di POSIX + stdout UTF-8; console Windows (UTF-16) dan
+        # encoding lain tetap lewat sys.stdout supaya '─', '→', '←' benar
+        self._stdout_fd = None
+        encoding = (getattr(sys.stdout, 'encoding', None) or '').lower().replace('-', '')
+        if self.USE_SELECT and encoding == 'utf8':
+            try:
+                self._stdout_fd = sys.stdout.fileno()
+            except (AttributeError, OSError, ValueError):
+                pass
+        
+        out = []
+        log_batch = self._line_buf
+        running = True
+        output_errors = 0
+        while running:
+            # Ambil juga packet yang sudah antre → satu write stdout + satu write log per batch
+            items = [self.output_queue.get()]
+            try:
+                while len(items) < self.OUTPUT_BATCH:
+                    items.append(self.output_queue.get_nowait())
+            except queue.Empty:
+                pass
+            
+            out.clear()
+            log_batch.clear()
+            # Error tak terduga di satu batch tidak boleh mematikan thread ini:
+            # antrian bounded akan penuh dan stop_tapping menunggu selamanya
+            try:
+                for item in items:
+                    if item is None:
+                        running = False
+                        break
+                    
+                    conn_info, data, ns, direction = item
+                    
+                    base = conn_info['idx'] * self.STAT_FIELDS
+                    if direction == "TX":
+                        self.stats[base + self.STAT_TX] += 1
+                        self.stats[base + self.STAT_TX_BYTES] += len(data)
+                    else:
+                        self.stats[base + self.STAT_RX] += 1
+                        self.stats[base + self.STAT_RX_BYTES] += len(data)
+                    
+                    # Quiet + log biner: tidak ada yang butuh timestamp teks/hex
+                    timestamp = self._timestamp(ns) if need_ts else None
+                    
+                    # Hex dipakai display dan log → format sekali saja
+                    hex_str = self.format_hex(data) if self._share_hex else None
+                    if show:
+                        self.display_data(conn_info, data, timestamp, direction, hex_str, out)
+                    
+                    if self._log_fh is not None:
+                        self.write_to_log(conn_info, data, timestamp, direction, hex_str, log_batch, ns)
                 
-                direction = self.detect_direction_smart(
-                    port_name, port_type, detection_mode, complete_packet, conn_info
-                )
+                if out:
+                    try:
+                        self._write_stdout(''.join(out))
+                    except OSError as e:
+                        # stdout putus (mis. `| head` selesai) → lanjut log saja, jangan matikan thread
+                        sys.stderr.write(f"Warning: console output stopped ({e}), logging continues\n")
+                        self.quiet = True
+                        show = False
+                        self._share_hex = False
+                        self._discard_stdout()
+                if log_batch:
+                    self._write_log(log_batch)
+            except Exception as e:
+                if not output_errors:
+                    sys.stderr.write(f"Error in output thread: {e!r} - batch dilewati, "
+                                     f"error berikutnya tidak dilaporkan\n")
+                output_errors += 1
+                if any(item is None for item in items):
+                    running = False
+    
+    def _write_stdout(self, text):
+        """Satu batch display langsung ke fd stdout (tanpa TextIOWrapper per batch)"""
+        if self._stdout_fd is None:
+            try:
+                sys.stdout.write(text)
+            except UnicodeEncodeError:
+                # Console non-UTF-8 (mis. cp1252): '─', '→', '←' jadi '?' daripada error
+                encoding = sys.stdout.encoding or 'ascii'
+                sys.stdout.write(text.encode(encoding, 'replace').decode(encoding))
+            return
+        
+        # print() dari thread lain masih lewat sys.stdout → flush dulu supaya urutan terjaga
+        sys.stdout.flush()
+        view = memoryview(text.encode('utf-8', 'replace'))
+        while view:
+            view = view[os.write(self._stdout_fd, view):]
+    
+    def _discard_stdout(self):
+        """
+        Arahkan fd stdout yang putus ke devnull, supaya print() berikutnya
+        (Stopping, statistik) tidak melempar BrokenPipeError di main thread
+        dan stop_tapping tetap jalan sampai log ditutup
+        """
+        try:
+            fd = sys.stdout.fileno()
+            devnull = os.open(os.devnull, os.O_WRONLY)
+            os.dup2(devnull, fd)
+            os.close(devnull)
+        except (AttributeError, OSError, ValueError):
+            pass
+    
+    def _handle_chunk(self, conn_info, chunk):
+        """Gabungkan chunk ke packet buffer, flush dulu kalau gap > packet_timeout"""
+        current_time = time.monotonic_ns()
+        
+        buf = conn_info['buf']
+        if buf and current_time - conn_info['last_rx'] > conn_info['packet_timeout_ns']:
+            self.flush_packet_buffer(conn_info)
+            buf = conn_info['buf']
+        
+        # Stream tanpa gap dipotong per MAX_PACKET_SIZE supaya satu record
+        # display/log tidak membengkak (dan tidak menahan output thread)
+        room = self.MAX_PACKET_SIZE - len(buf)
+        while len(chunk) > room:
+            buf.extend(chunk[:room])
+            # Sisa burst adalah transmisi yang sama → arah dibawa ke potongan berikutnya
+            conn_info['cont_dir'] = self.flush_packet_buffer(conn_info)
+            chunk = chunk[room:]
+            buf = conn_info['buf']
+            room = self.MAX_PACKET_SIZE
+        
+        buf.extend(chunk)
+        conn_info['last_rx'] = current_time
+    
+    def _flush_stale_buffers(self):
+        """
+        Flush semua buffer yang sudah idle lebih lama dari packet_timeout-nya
+        
+        Returns:
+            Detik sampai deadline flush berikutnya (maks IDLE_TICK), dipakai
+            sebagai timeout select supaya reader hanya bangun saat perlu
+        """
+        current_time = time.monotonic_ns()
+        next_timeout = self.IDLE_TICK
+        for conn_info in self.serial_connections:
+            if not conn_info['buf']:
+                continue
+            remaining = conn_info['last_rx'] + conn_info['packet_timeout_ns'] - current_time
+            if remaining < 0:
+                self.flush_packet_buffer(conn_info)
+            else:
+                next_timeout = min(next_timeout, remaining / 1e9)
+        return next_timeout
+    
+    def _read_failed(self, selector, key, conn_info, error):
+        """
+        Read kosong (error None) atau OSError di select_loop. Port baru dilepas
+        setelah READ_FAIL_LIMIT kali beruntun, atau langsung untuk EIO/ENXIO.
+        """
+        conn_info['read_fails'] += 1
+        fatal = error is not None and error.errno in self.FATAL_READ_ERRNOS
+        if not fatal and conn_info['read_fails'] < self.READ_FAIL_LIMIT:
+            return
+        
+        reason = error if error is not None else "device disconnected"
+        print(f"{self.colors['red']}ERROR reading from {conn_info['label']}: {reason}{self.colors['reset']}")
+        selector.unregister(key.fd)
+    
+    def select_loop(self):
+        """
+        Satu thread untuk semua port: tunggu fd readable via selectors (epoll/kqueue)
+        
+        Tidak ada busy-poll: thread tidur di kernel sampai ada data, atau sampai
+        deadline flush terdekat (IDLE_TICK kalau semua buffer kosong).
+        """
+        if not self.serial_connections:
+            return
+        
+        selector = selectors.DefaultSelector()
+        for conn_info in self.serial_connections:
+            selector.register(conn_info['serial'].fileno(), selectors.EVENT_READ, data=conn_info)
+        
+        timeout = self.IDLE_TICK
+        
+        # Scratch buffer tetap untuk semua read; isinya langsung dicopy ke buf packet
+        rx_buf = bytearray(self.READ_SIZE)
+        rx_view = memoryview(rx_buf)
+        rx_bufs = (rx_buf,)
+        
+        # Method/fungsi hot loop di-bind ke lokal sekali
+        select = selector.select
+        readv = os.readv
+        handle_chunk = self._handle_chunk
+        flush_stale = self._flush_stale_buffers
+        
+        try:
+            while self.running and selector.get_map():
+                for key, _ in select(timeout=timeout):
+                    conn_info = key.data
+                    try:
+                        n = readv(key.fd, rx_bufs)
+                    except (BlockingIOError, InterruptedError):
+                        continue  # readiness palsu / signal, coba lagi di select berikutnya
+                    except OSError as e:
+                        self._read_failed(selector, key, conn_info, e)
+                        continue
+                    
+                    if not n:
+                        # VMIN=0: satu event kosong bisa palsu; berulang = device dicabut
+                        self._read_failed(selector, key, conn_info, None)
+                        continue
+                    
+                    if conn_info['read_fails']:
+                        conn_info['read_fails'] = 0
+                    
+                    handle_chunk(conn_info, rx_view[:n])
                 
-                self.display_data(conn_info, complete_packet, timestamp, direction)
+                timeout = flush_stale()
+        except Exception as e:
+            print(f"{self.colors['red']}Unexpected error in reader loop: {e}{self.colors['reset']}")
+        finally:
+            selector.close()
+    
+    def port_read_loop(self, conn_info):
+        """
+        Fallback satu thread per port untuk platform tanpa select() di serial
+        (Windows). read(1) blok sampai ada data atau packet_timeout habis,
+        sisanya di-drain lewat in_waiting; timeout kosong = akhir packet.
+        """
+        ser = conn_info['serial']
+        # timeout 0 = non-blocking di pyserial → loop ini spin 100% CPU
+        ser.timeout = max(conn_info['packet_timeout'], self.MIN_READ_TIMEOUT)
+        
+        try:
+            while self.running:
+                chunk = ser.read(1)
+                if not chunk:
+                    self.flush_packet_buffer(conn_info)
+                    continue
                 
-                if self.log_file:
-                    self.write_to_log(conn_info, complete_packet, timestamp, direction)
+                waiting = ser.in_waiting
+                if waiting:
+                    chunk += ser.read(min(waiting, self.READ_SIZE))
                 
-                self.packet_buffer[port_name] = bytearray()
+                self._handle_chunk(conn_info, chunk)
+        except Exception as e:
+            print(f"{self.colors['red']}ERROR reading from {conn_info['label']}: {e}{self.colors['reset']}")
     
-    def read_port(self, conn_info):
-        """Thread untuk baca port dengan per-port packet timeout"""
-        conn = conn_info['serial']
-        port = conn_info['port']
-        packet_timeout = conn_info.get('packet_timeout', 0.05)
+    def dump_binary_log(self, path):
+        """
+        Decode log biner (--log-format binary) ke stdout dalam format log teks (hex)
+        
+        Sesi yang mati saat flush meninggalkan record terpotong, lalu sesi berikutnya
+        di-append tepat setelahnya. Record yang payload-nya memuat BIN_MAGIC, atau
+        idx-nya tidak ada di label sesi, dianggap rusak → scan maju ke BIN_MAGIC berikutnya.
+        """
+        magic = self.BIN_MAGIC
+        record = self.BIN_RECORD
+        labels = []
         
-        while self.running:
+        with open(path, 'rb') as f:
             try:
-                if conn.in_waiting > 0:
-                    chunk = conn.read(conn.in_waiting)
-                    current_time = time.time()
-                    
-                    with self.buffer_lock:
-                        if port in self.last_receive_time:
-                            time_gap = current_time - self.last_receive_time[port]
-                            
-                            if time_gap > packet_timeout:
-                                if len(self.packet_buffer[port]) > 0:
-                                    self.flush_packet_buffer(port, conn_info)
-                        
-                        self.packet_buffer[port].extend(chunk)
-                        self.last_receive_time[port] = current_time
-                
-                # Check timeout flush
-                current_time = time.time()
-                if port in self.last_receive_time:
-                    time_since_last = current_time - self.last_receive_time[port]
-                    if time_since_last > packet_timeout and len(self.packet_buffer[port]) > 0:
-                        self.flush_packet_buffer(port, conn_info)
-                
-                time.sleep(0.001)
+                buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            except ValueError:
+                return  # file kosong
+        
+        with buf:
+            size = len(buf)
+            pos = 0
+            while pos < size:
+                if buf[pos:pos + len(magic)] == magic:
+                    # Awal sesi baru (file di-append beberapa kali)
+                    eol = buf.find(b'\n', pos + len(magic))
+                    if eol < 0:
+                        break
+                    try:
+                        labels = json.loads(buf[pos + len(magic):eol])
+                        pos = eol + 1
+                        continue
+                    except ValueError:
+                        labels = []
+                    resync = pos + 1
+                else:
+                    end = pos + record.size
+                    if end > size:
+                        break
+                    ns, idx, is_rx, length = record.unpack_from(buf, pos)
+                    # BIN_MAGIC yang *mulai* sebelum akhir payload → record ini terpotong
+                    if (idx < len(labels)
+                            and buf.find(magic, pos + 1, end + length + len(magic) - 1) < 0):
+                        if end + length > size:
+                            break  # record terakhir terpotong (tapper mati saat menulis)
+                        sys.stdout.write(f"{labels[idx]} | {'RX' if is_rx else 'TX'} : "
+                                         f"{self._timestamp(ns)} {self.format_hex(buf[end:end + length])}\n")
+                        pos = end + length
+                        continue
+                    resync = pos + 1
                 
-            except serial.SerialException as e:
-                print(f"{self.colors['red']}ERROR reading from {conn_info['label']}: {e}{self.colors['reset']}")
-                break
-            except Exception as e:
-                print(f"{self.colors['red']}Unexpected error on {conn_info['label']}: {e}{self.colors['reset']}")
-                break
+                # Data rusak: lompat ke header sesi berikutnya
+                nxt = buf.find(magic, resync)
+                skipped = (nxt if nxt >= 0 else size) - pos
+                sys.stderr.write(f"Warning: {skipped} byte rusak di-skip (offset {pos})\n")
+                if nxt < 0:
+                    pos = size
+                    break
+                labels = []
+                pos = nxt
+            
+            # Berhenti sebelum EOF: label/header/payload terakhir terpotong
+            if pos < size:
+                sys.stderr.write(f"Warning: {size - pos} byte terpotong di akhir file di-skip "
+                                 f"(offset {pos})\n")
     
     def print_statistics(self):
         """Print statistics"""
@@ -573,16 +1166,19 @@ class SerialTapper:
             label = conn['label']
             port_type = conn.get('type', 'RS232')
             detection = conn.get('detection', 'auto')
-            stats = self.stats[port]
+            base = conn['idx'] * self.STAT_FIELDS
+            tx, rx, tx_bytes, rx_bytes, dropped = self.stats[base:base + self.STAT_FIELDS]
             
             print(f"  {label:<30} ({port})")
             print(f"    Type: {port_type} | Detection: {detection}")
             print(f"    Config: {conn['baudrate']} {conn['bytesize']}{conn['parity']}{conn['stopbits']}")
-            print(f"    Packets: {stats['packets']} ({stats['bytes']} bytes)")
+            print(f"    Packets: {tx + rx} ({tx_bytes + rx_bytes} bytes)")
             
             if detection != 'none':
-                print(f"    TX: {stats['tx']} pkts ({stats['tx_bytes']} bytes) | "
-                      f"RX: {stats['rx']} pkts ({stats['rx_bytes']} bytes)")
+                print(f"    TX: {tx} pkts ({tx_bytes} bytes) | "
+                      f"RX: {rx} pkts ({rx_bytes} bytes)")
+            if dropped:
+                print(f"    {self.colors['red']}Dropped: {dropped} pkts (output queue full){self.colors['reset']}")
             print()
         
         print("="*80 + "\n")
@@ -608,16 +1204,48 @@ class SerialTapper:
         print(f"\n  {self.colors['yellow']}Press Ctrl+C to stop{self.colors['reset']}")
         print("="*80 + "\n")
         
-        # Create threads
-        for conn_info in self.serial_connections:
+        self.output_thread = threading.Thread(
+            target=self.output_loop,
+            daemon=True,
+            name="Tapper-output"
+        )
+        self.output_thread.start()
+        
+        if self.USE_SELECT:
+            # Satu reader thread untuk semua port (selectors)
             thread = threading.Thread(
-                target=self.read_port,
-                args=(conn_info,),
+                target=self.select_loop,
                 daemon=True,
-                name=f"Tapper-{conn_info['port']}"
+                name="Tapper-select"
             )
             thread.start()
             self.threads.append(thread)
+            for conn_info in self.serial_connections:
+                conn_info['reader'] = thread
+        else:
+            for conn_info in self.serial_connections:
+                thread = threading.Thread(
+                    target=self.port_read_loop,
+                    args=(conn_info,),
+                    daemon=True,
+                    name=f"Tapper-{conn_info['label']}"
+                )
+                thread.start()
+                self.threads.append(thread)
+                conn_info['reader'] = thread
+        
+        if self._log_fh is not None:
+            flusher = threading.Thread(
+                target=self._log_flush_loop,
+                daemon=True,
+                name="Tapper-logflush"
+            )
+            flusher.start()
+            self.threads.append(flusher)
+        
+        # SIGTERM (run_tap.sh stop) → jalur stop normal, supaya log ter-flush
+        if threading.current_thread() is threading.main_thread():
+            signal.signal(signal.SIGTERM, self._handle_sigterm)
         
         try:
             while self.running:
@@ -626,19 +1254,39 @@ class SerialTapper:
             print(f"\n\n{self.colors['yellow']}Stopping...{self.colors['reset']}")
             self.stop_tapping()
     
+    def _handle_sigterm(self, signum, frame):
+        raise KeyboardInterrupt
+    
     def stop_tapping(self):
         """Stop monitoring"""
         self.running = False
-        
-        for port in list(self.packet_buffer.keys()):
-            for conn in self.serial_connections:
-                if conn['port'] == port:
-                    self.flush_packet_buffer(port, conn)
-                    break
+        self.stop_event.set()
         
         for thread in self.threads:
             thread.join(timeout=1)
         
+        # Flush sisa buffer dari thread ini hanya kalau reader-nya sudah berhenti
+        # (join bisa timeout; reader yang masih jalan juga menyentuh conn['buf'])
+        for conn in self.serial_connections:
+            reader = conn.get('reader')
+            if reader is None or not reader.is_alive():
+                self.flush_packet_buffer(conn)
+            else:
+                print(f"{self.colors['yellow']}Warning: reader {conn['label']} belum berhenti - "
+                      f"sisa buffer tidak di-flush{self.colors['reset']}")
+        
+        # Drain sisa antrian display/log sebelum statistik & close
+        # (dengan timeout: output thread yang macet tidak boleh menahan shutdown)
+        if self.output_thread is not None and self.output_thread.is_alive():
+            try:
+                self.output_queue.put(None, timeout=self.STOP_TIMEOUT)
+            except queue.Full:
+                pass
+            self.output_thread.join(timeout=self.STOP_TIMEOUT)
+            if self.output_thread.is_alive():
+                print(f"{self.colors['yellow']}Warning: output thread tidak berhenti dalam "
+                      f"{self.STOP_TIMEOUT:.0f}s - sisa antrian tidak ditulis{self.colors['reset']}")
+        
         self.print_statistics()
         self.close_connections()
         
@@ -699,17 +1347,36 @@ def parse_port_config(port_str):
         config['stopbits'] = float(parts[5].strip())
     
     if len(parts) >= 7:
-        config['type'] = parts[6].strip().upper()
+        port_type = parts[6].strip().upper()
+        if port_type not in PORT_TYPES:
+            print(f"{ColorText.YELLOW}Warning: Unknown port type {port_type!r}, using RS232{ColorText.RESET}")
+            port_type = 'RS232'
+        config['type'] = port_type
     
     if len(parts) >= 8:
         config['detection'] = parts[7].strip().lower()
     
     if len(parts) >= 9:
-        config['packet_timeout'] = int(parts[8].strip()) / 1000.0
+        # Validasi sama dengan --packet-timeout
+        try:
+            config['packet_timeout'] = _ms_to_seconds(parts[8].strip())
+        except argparse.ArgumentTypeError as e:
+            raise ValueError(str(e))
     
     return config
 
 
+def _ms_to_seconds(ms):
+    """argparse type: milidetik (boleh pecahan, mis. 2.5) → detik"""
+    try:
+        value = float(ms)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"invalid timeout {ms!r} (expected milliseconds, e.g. 50)")
+    if not 0 <= value < float('inf'):  # juga menolak nan/inf
+        raise argparse.ArgumentTypeError(f"invalid timeout {ms!r} (must be a finite value >= 0 ms)")
+    return value / 1000.0
+
+
 def main():
     parser = argparse.ArgumentParser(
         description='Serial Port Tapper v5.0 - Ultimate Edition',
@@ -769,6 +1436,28 @@ LOG FILE VARIABLES:
     parser.add_argument('-p', '--port', action='append', dest='ports',
                         help='Port config (full format or simple)')
     
+    # Default untuk semua port; field yang ditulis di -p tetap menang
+    # (konversi satuan di type=, sekali saat parse)
+    parser.add_argument('-b', '--baudrate', type=int,
+                        help='Default baudrate (default: 9600)')
+    
+    parser.add_argument('--bytesize', type=int, choices=[5, 6, 7, 8],
+                        help='Default data bits (default: 8)')
+    
+    parser.add_argument('--parity', type=str.upper, choices=['N', 'E', 'O', 'M', 'S'],
+                        help='Default parity (default: N)')
+    
+    parser.add_argument('--stopbits', type=float, choices=[1, 1.5, 2],
+                        help='Default stop bits (default: 1)')
+    
+    parser.add_argument('--packet-timeout', dest='packet_timeout', metavar='MS',
+                        type=_ms_to_seconds,
+                        help='Default packet timeout in ms (default: 50)')
+    
+    parser.add_argument('--detection', type=str.lower,
+                        choices=['auto', 'alternating', 'pattern', 'size', 'rs485', 'none'],
+                        help='Default detection mode (default: auto)')
+    
     parser.add_argument('-d', '--display', dest='display_mode',
                         choices=['hex', 'ascii', 'both'], default='both',
                         help='Display mode (default: both)')
@@ -777,36 +1466,80 @@ LOG FILE VARIABLES:
                         help='Log file path (supports variables)')
     
     parser.add_argument('--log-format', dest='log_format',
-                        choices=['hex', 'ascii'], default='hex',
-                        help='Log format (default: hex)')
+                        choices=['hex', 'ascii', 'binary'], default='hex',
+                        help='Log format (default: hex; binary = raw records, decode with --dump)')
+    
+    parser.add_argument('-q', '--quiet', action='store_true',
+                        help='No per-packet console output (log + statistics only)')
+    
+    parser.add_argument('--color', choices=['auto', 'always', 'never'], default='auto',
+                        help='ANSI colors (default: auto = only when stdout is a terminal)')
+    
+    parser.add_argument('--low-latency', dest='low_latency', action='store_true',
+                        help='Set ASYNC_LOW_LATENCY on USB-serial ports (Linux, FTDI 16ms -> ~1ms)')
+    
+    parser.add_argument('--latency-timer', dest='latency_timer', type=int, metavar='MS',
+                        help='Write FTDI sysfs latency_timer in ms (default: 1 with --low-latency)')
     
     parser.add_argument('--list', action='store_true',
                         help='List available ports')
     
+    parser.add_argument('--dump', metavar='BIN_LOG',
+                        help='Decode a binary log to the text log format on stdout')
+    
+    parser.add_argument('--show-ports', dest='show_ports', action='store_true',
+                        help='List available ports before tapping (skipped by default)')
+    
     args = parser.parse_args()
+    ColorText.configure(args.color)
     
     if args.list:
         tapper = SerialTapper([])
         tapper.list_available_ports()
         return
     
+    if args.dump:
+        try:
+            SerialTapper([]).dump_binary_log(args.dump)
+        except OSError as e:
+            print(f"\n{ColorText.RED}Error: {e}{ColorText.RESET}\n", file=sys.stderr)
+            sys.exit(1)
+        return
+    
     if not args.ports:
         print(f"\n{ColorText.RED}Error: At least 1 port required!{ColorText.RESET}\n")
         parser.print_help()
         sys.exit(1)
     
     # Parse port configs
+    defaults = {key: value for key, value in (
+        ('baudrate', args.baudrate),
+        ('bytesize', args.bytesize),
+        ('parity', args.parity),
+        ('stopbits', args.stopbits),
+        ('packet_timeout', args.packet_timeout),
+        ('detection', args.detection),
+    ) if value is not None}
+    
     tap_ports = []
     for port_str in args.ports:
-        config = parse_port_config(port_str)
+        try:
+            config = parse_port_config(port_str)
+        except ValueError as e:
+            print(f"\n{ColorText.RED}Error: Invalid port config {port_str!r}: {e}{ColorText.RESET}\n",
+                  file=sys.stderr)
+            sys.exit(1)
+        for key, value in defaults.items():
+            config.setdefault(key, value)
         tap_ports.append(config)
     
     # Process log file
     log_file = None
     if args.log_file:
         log_file = expand_log_variables(args.log_file)
-        if not log_file.endswith('.txt'):
-            log_file = f"{log_file}.txt"
+        ext = '.bin' if args.log_format == 'binary' else '.txt'
+        if not log_file.endswith(ext):
+            log_file += ext
         print(f"\n{ColorText.GREEN}Log file: {log_file}{ColorText.RESET}")
     
     # Create and start
@@ -815,18 +1548,23 @@ LOG FILE VARIABLES:
             tap_ports=tap_ports,
             log_file=log_file,
             display_mode=args.display_mode,
-            log_format=args.log_format
+            log_format=args.log_format,
+            low_latency=args.low_latency,
+            latency_timer=args.latency_timer,
+            quiet=args.quiet,
+            color=args.color
         )
         
-        tapper.list_available_ports()
+        # Scan comports() lambat di sistem dengan banyak tty/USB → hanya kalau diminta
+        if args.show_ports:
+            tapper.list_available_ports()
         tapper.open_connections()
         tapper.start_tapping()
         
     except KeyboardInterrupt:
         print("\n\nInterrupted")
     except Exception as e:
-        print(f"\n{ColorText.RED}Error: {e}{ColorText.RESET}\n")
-        import traceback
+        print(f"\n{ColorText.RED}Error: {e}{ColorText.RESET}\n", file=sys.stderr)
         traceback.print_exc()
         sys.exit(1)
 
@@ -836,6 +1574,12 @@ class ColorText:
     GREEN = '\033[92m'
     YELLOW = '\033[93m'
     RESET = '\033[0m'
+    
+    @classmethod
+    def configure(cls, color='auto'):
+        """Kosongkan escape ANSI sekali di awal (sama seperti SerialTapper.colors)"""
+        if color == 'never' or (color == 'auto' and not sys.stdout.isatty()):
+            cls.RED = cls.GREEN = cls.YELLOW = cls.RESET = ''
 
 
 if __name__ == '__main__':